@@ -10,72 +10,207 @@ Each lane uses 2 bits per row:
     01 = tail
     10 = head
     11 = unused
+
+By default rows are written as text lines of '0'/'1' for $readmemb. With
+--binary each row is written as a single raw byte instead, grouped into
+little-endian 64-bit words of 8 rows (row 0 in the low byte) and zero-padded
+to a whole word.
 """
 
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
 import mido
+import numpy as np
+
+try:
+    import symusic
+except ImportError:
+    symusic = None
+
+try:
+    from numba import njit
+except ImportError:
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+# Text form of every packed row byte, e.g. ROW_TEXT[0b10000000] == "10000000"
+ROW_TEXT = np.array([f"{i:08b}" for i in range(256)])
+
+
+def scan_track_symusic(track):
+    """Read one symusic track's notes as start/end ticks and pitches, paired like mido."""
+    arrays = track.notes.numpy()
+    starts = arrays["time"].astype(np.int64)
+    return pair_like_mido(starts, starts + arrays["duration"], arrays["pitch"].astype(np.int64))
+
+
+def collect_notes_symusic(midi_path):
+    """Read note start/end ticks, pitches and ticks per beat using symusic."""
+    score = symusic.Score(midi_path, ttype="tick")
+
+    # Tracks carry their own timing and pairing, so each is scanned independently. Pool startup
+    # costs more than scanning a single track, so only multi-track files use threads.
+    if len(score.tracks) <= 1:
+        scanned = [scan_track_symusic(track) for track in score.tracks]
+    else:
+        with ThreadPoolExecutor(max_workers=len(score.tracks)) as pool:
+            scanned = list(pool.map(scan_track_symusic, score.tracks))
+
+    if not scanned:
+        return np.empty((3, 0), dtype=np.int64), score.tpq
+
+    # Keep notes in track order, as the mido scan emits them
+    starts, ends, pitches = zip(*scanned)
+    notes = np.concatenate(starts), np.concatenate(ends), np.concatenate(pitches)
+    return notes, score.tpq
+
+
+def pair_like_mido(starts, ends, pitches):
+    """Re-pair one symusic track's notes the way collect_notes_mido pairs note_on/note_off.
 
+    symusic closes the oldest held note of a pitch first, so a retriggered pitch becomes
+    overlapping notes. The mido scan holds one start per pitch: a note_on overwrites it and
+    the next note_off closes it. Replaying symusic's note boundaries through that rule gives
+    the mido notes whenever every note_on is eventually closed. Remaining differences, all
+    from events symusic does not keep: note_ons never closed can shift which start a later
+    note_off closes (mido can even carry them into the next track), same-tick events follow
+    note_off-before-note_on order rather than file order, and symusic splits a MIDI track
+    by channel, so one pitch overlapping on two channels of a track is not re-paired.
+    """
+    n = starts.size
+    times = np.concatenate([starts, ends])
+    is_on = np.arange(2 * n) < n
+    event_pitch = np.concatenate([pitches, pitches])
 
-def midi_to_chart(midi_path, output_path, lane_notes, subdivision=4, rows_per_step=4):
+    # At one tick, note_offs close held notes before new note_ons start; a zero-length
+    # note's own note_off still follows its note_on
+    priority = np.concatenate([np.ones(n), np.where(ends == starts, 2, 0)])
+    timeline = np.lexsort((priority, times))
+    rank = np.empty(2 * n, dtype=np.int64)
+    rank[timeline] = np.arange(2 * n)
+
+    # Per pitch in timeline order, a note_off right after a note_on closes that note
+    order = timeline[np.argsort(event_pitch[timeline], kind="stable")]
+    p, on, t = event_pitch[order], is_on[order], times[order]
+    closes = on[:-1] & ~on[1:] & (p[:-1] == p[1:])
+
+    # Keep notes in note_off order, as the mido scan emits them
+    emitted = np.argsort(rank[order][1:][closes], kind="stable")
+    return t[:-1][closes][emitted], t[1:][closes][emitted], p[1:][closes][emitted]
+
+
+def collect_notes_mido(midi_path):
+    """Read note start/end ticks, pitches and ticks per beat using mido."""
     mid = mido.MidiFile(midi_path)
-    ticks_per_beat = mid.ticks_per_beat
-    ticks_per_step = ticks_per_beat // subdivision
+
+    # Every note_off closes at most one note, so the message count bounds the note count
+    max_notes = sum(len(track) for track in mid.tracks)
+    starts = np.empty(max_notes, dtype=np.int64)
+    ends = np.empty(max_notes, dtype=np.int64)
+    pitches = np.empty(max_notes, dtype=np.int64)
+    count = 0
 
     # Collect note-on and note-off events with absolute timing
-    notes = []  # (start_tick, end_tick, note)
-    active = {}  # note -> start_tick
+    active_start = np.full(128, -1, dtype=np.int64)  # note -> start_tick, -1 if not held
 
     for track in mid.tracks:
         abs_time = 0
         for msg in track:
             abs_time += msg.time
             if msg.type == "note_on" and msg.velocity > 0:
-                active[msg.note] = abs_time
+                active_start[msg.note] = abs_time
             elif msg.type == "note_off" or (msg.type == "note_on" and msg.velocity == 0):
-                if msg.note in active:
-                    notes.append((active[msg.note], abs_time, msg.note))
-                    del active[msg.note]
+                start = active_start[msg.note]
+                if start >= 0:
+                    starts[count] = start
+                    ends[count] = abs_time
+                    pitches[count] = msg.note
+                    count += 1
+                    active_start[msg.note] = -1
+
+    return (starts[:count], ends[:count], pitches[:count]), mid.ticks_per_beat
+
+
+@njit(cache=True)
+def fill_chart(starts, ends, lanes, ticks_per_step, rows_per_step, chart):
+    """Stamp head (2) / tail (1) rows for each note into chart in place."""
+    num_rows = chart.shape[0]
+    for i in range(starts.shape[0]):
+        lane = lanes[i]
+        start_row = (starts[i] // ticks_per_step) * rows_per_step
+        end_row = min((ends[i] // ticks_per_step) * rows_per_step, num_rows)
+        head_end = min(start_row + rows_per_step, end_row)
 
-    if not notes:
+        # First 4 rows are head (2), rest are tail (1)
+        for row in range(start_row, head_end):
+            chart[row, lane] = 2  # head
+        for row in range(head_end, end_row):
+            chart[row, lane] = 1  # tail
+
+
+def midi_to_chart(midi_path, output_path, lane_notes, subdivision=4, rows_per_step=4, binary=False):
+    # symusic parses in C++ and pairs note on/off itself; mido is the slow fallback
+    if symusic is not None:
+        notes, ticks_per_beat = collect_notes_symusic(midi_path)
+    else:
+        notes, ticks_per_beat = collect_notes_mido(midi_path)
+    ticks_per_step = ticks_per_beat // subdivision
+
+    starts, ends, pitches = notes
+    if starts.size == 0:
         print("No notes found")
         return
 
     # Find chart length in rows
-    max_tick = max(end for _, end, _ in notes)
+    max_tick = int(ends.max())
     num_steps = (max_tick // ticks_per_step) + 1
     num_rows = num_steps * rows_per_step
 
     # Build chart: 0 = none, 1 = tail, 2 = head
-    chart = [[0, 0, 0, 0] for _ in range(num_rows)]
+    chart = np.zeros((num_rows, 4), dtype=np.uint8)
 
-    for start_tick, end_tick, note in notes:
-        if note not in lane_notes:
-            continue
-        lane = lane_notes.index(note)
+    # MIDI note -> lane, -1 for notes not mapped to a lane
+    lane_of = np.full(128, -1, dtype=np.int8)
+    for i, note in enumerate(lane_notes):
+        if not 0 <= note < 128:
+            raise ValueError(f"lane note {note} is outside the MIDI range 0-127")
+        lane_of[note] = i
+    lanes = lane_of[pitches]
 
-        start_step = start_tick // ticks_per_step
-        end_step = end_tick // ticks_per_step
+    in_lane = lanes >= 0
+    starts, ends, lanes = starts[in_lane], ends[in_lane], lanes[in_lane]
 
-        start_row = start_step * rows_per_step
-        end_row = end_step * rows_per_step
+    fill_chart(starts, ends, lanes, ticks_per_step, rows_per_step, chart)
 
-        # First 4 rows are head (2), rest are tail (1)
-        for row in range(start_row, end_row):
-            if row < num_rows:
-                if row < start_row + rows_per_step:
-                    chart[row][lane] = 2  # head
-                else:
-                    chart[row][lane] = 1  # tail
+    # Pack 2 bits per lane into one byte per row, lane 0 in the high bits
+    packed = (chart[:, 0] << 6) | (chart[:, 1] << 4) | (chart[:, 2] << 2) | chart[:, 3]
+
+    if binary:
+        # Pad with empty rows to whole 8-row words so 64-bit reads never straddle the end
+        rows = np.zeros(-(-num_rows // 8) * 8, dtype=np.uint8)
+        rows[:num_rows] = packed
+        rows.view("<u8").tofile(output_path)
+        return
 
     # Write output (2 bits per lane)
     with open(output_path, "w") as f:
-        for row in chart:
-            line = "".join(f"{val:02b}" for val in row)
-            f.write(line + "\n")
+        f.write("\n".join(ROW_TEXT[packed]) + "\n")
+
+
+def main():
+    binary = "--binary" in sys.argv[1:]
+
+    midi_to_chart(
+        "midi_track_chorded.mid",
+        "chart_chorded_v2.bin" if binary else "chart_chorded_v2.txt",
+        lane_notes=[60, 61, 62, 63],
+        subdivision=4,
+        binary=binary,
+    )
 
 
-midi_to_chart(
-    "midi_track_chorded.mid",
-    "chart_chorded_v2.txt",
-    lane_notes=[60, 61, 62, 63],
-    subdivision=4,
-)
+if __name__ == "__main__":
+    main()
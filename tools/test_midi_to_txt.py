@@ -0,0 +1,59 @@
+"""
+Regression checks for midi_to_txt.py: both MIDI backends must give the same notes.
+
+Run from tools/: python -m pytest test_midi_to_txt.py
+"""
+
+import mido
+import pytest
+
+from midi_to_txt import collect_notes_mido, collect_notes_symusic
+
+symusic = pytest.importorskip("symusic")
+
+
+def note_list(notes):
+    return list(zip(*(col.tolist() for col in notes)))
+
+
+def both_backends(midi_path):
+    """Return the (start, end, pitch) notes from the mido and symusic paths."""
+    mido_notes, mido_tpq = collect_notes_mido(str(midi_path))
+    symusic_notes, symusic_tpq = collect_notes_symusic(str(midi_path))
+    assert symusic_tpq == mido_tpq
+    return note_list(mido_notes), note_list(symusic_notes)
+
+
+def test_retriggered_pitch_pairs_like_mido(tmp_path):
+    """note_on 60 @0, note_on 60 @480, note_off @960, note_off @1440 -> one note (480, 960)."""
+    mid = mido.MidiFile(ticks_per_beat=480)
+    track = mido.MidiTrack()
+    mid.tracks.append(track)
+    track.append(mido.Message("note_on", note=60, velocity=100, time=0))
+    track.append(mido.Message("note_on", note=60, velocity=100, time=480))
+    track.append(mido.Message("note_off", note=60, velocity=0, time=480))
+    track.append(mido.Message("note_off", note=60, velocity=0, time=480))
+    midi_path = tmp_path / "retrigger.mid"
+    mid.save(midi_path)
+
+    mido_notes, symusic_notes = both_backends(midi_path)
+
+    assert mido_notes == [(480, 960, 60)]
+    assert symusic_notes == mido_notes
+
+
+def test_same_pitch_overlapping_across_tracks_keeps_both_notes(tmp_path):
+    """Track 1 holds 60 over 0-960 and track 2 over 480-1440; tracks pair independently."""
+    mid = mido.MidiFile(ticks_per_beat=480)
+    for start, end in [(0, 960), (480, 1440)]:
+        track = mido.MidiTrack()
+        mid.tracks.append(track)
+        track.append(mido.Message("note_on", note=60, velocity=100, time=start))
+        track.append(mido.Message("note_off", note=60, velocity=0, time=end - start))
+    midi_path = tmp_path / "two_tracks.mid"
+    mid.save(midi_path)
+
+    mido_notes, symusic_notes = both_backends(midi_path)
+
+    assert mido_notes == [(0, 960, 60), (480, 1440, 60)]
+    assert symusic_notes == mido_notes
@@ -1,39 +1,202 @@
 """
 Write Raw Audio to SD Card for FPGA Playback
 
-Usage: sudo python write_sd_audio.py <audio_file> <device>
+Usage: sudo python write_sd_audio.py <audio_file> <device> [--dither]
 Example: sudo python write_sd_audio.py song.mp3 /dev/disk4
 
+--dither adds TPDF dither when quantizing to 16-bit (requires python-soxr).
+
 Output: 16-bit signed LE mono PCM at 46186Hz, starting at sector 0.
 Update MAX_SECTORS in audio_controller.sv with the printed value.
 """
 
+import errno
+import fcntl
+import mmap
 import os
+import shutil
 import subprocess
 import sys
-import tempfile
+import threading
+
+try:
+    import numpy as np
+    import soxr
+except ImportError:
+    soxr = None
 
 # 25.125MHz PLL / 17 (BCLK_DIV) / 32 (bits per frame) = 46186Hz
 SAMPLE_RATE = 46186
 BITS_PER_SAMPLE = 16
 CHANNELS = 1
 SECTOR_SIZE = 512
+WRITE_BLOCK_SIZE = 1 << 20  # 2048 sectors per write syscall
+PIPE_READ_SIZE = 1 << 16
 
+# No stdin/console setup, errors only on stderr, decode on all cores
+FFMPEG = ["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-threads", "0"]
 
-def convert_audio(input_file: str) -> bytes:
-    """Convert audio file to raw 16-bit mono PCM using ffmpeg."""
-    print(f"Loading: {input_file}")
 
-    with tempfile.NamedTemporaryFile(suffix=".raw", delete=False) as tmp:
-        tmp_path = tmp.name
+def run_ffmpeg(cmd: list, consume) -> tuple:
+    """Run ffmpeg, handing its stdout pipe to consume().
+
+    Returns (returncode, consume() result, stderr).
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1 << 20)
+
+    # Drain stderr on the side so a chatty ffmpeg can't block on a full pipe
+    stderr = []
+    drain = threading.Thread(target=lambda: stderr.append(proc.stderr.read()))
+    drain.start()
 
     try:
-        # Try soxr resampler first, fall back to default
-        cmd_base = [
-            "ffmpeg",
+        result = consume(proc.stdout)
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.wait()
+        drain.join()
+
+    return proc.returncode, result, stderr[0]
+
+
+def write_blocks(fd: int, chunks) -> int:
+    """Write byte chunks to fd in 1 MiB blocks, zero-padding the last to a whole sector.
+
+    Returns the number of bytes written, not counting sector padding.
+    """
+    total = 0
+    filled = 0
+
+    # Anonymous mmap is page-aligned, so it is a valid O_DIRECT source
+    with mmap.mmap(-1, WRITE_BLOCK_SIZE) as block, memoryview(block) as out:
+        for chunk in chunks:
+            data = memoryview(chunk).cast("B")
+            pos = 0
+            while pos < len(data):
+                n = min(WRITE_BLOCK_SIZE - filled, len(data) - pos)
+                out[filled : filled + n] = data[pos : pos + n]
+                filled += n
+                pos += n
+                if filled == WRITE_BLOCK_SIZE:
+                    flush_block(fd, out, filled)
+                    filled = 0
+            total += len(data)
+
+        if filled:
+            flush_block(fd, out, filled)
+
+    return total
+
+
+def flush_block(fd: int, out: memoryview, filled: int) -> None:
+    """Write the first filled bytes of out to fd, zero-padded up to a whole sector."""
+    padded = -(-filled // SECTOR_SIZE) * SECTOR_SIZE
+    out[filled:padded] = bytes(padded - filled)
+
+    written = 0
+    while written < padded:
+        written += os.write(fd, out[written:padded])
+
+    sector = os.lseek(fd, 0, os.SEEK_CUR) // SECTOR_SIZE
+    print(f"  Sector {sector:,}")
+
+
+def probe_audio(input_file: str) -> tuple:
+    """Read (sample_rate, channels) of the first audio stream using ffprobe."""
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "a:0",
+        "-show_entries",
+        "stream=sample_rate,channels",
+        "-of",
+        "default=noprint_wrappers=1",
+        input_file,
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    fields = dict(line.split("=", 1) for line in result.stdout.split())
+    if result.returncode != 0 or "sample_rate" not in fields or "channels" not in fields:
+        print(f"ffprobe error: {result.stderr or 'no audio stream found'}")
+        sys.exit(1)
+
+    return int(fields["sample_rate"]), int(fields["channels"])
+
+
+def quantize_s16(samples, rng=None):
+    """Quantize float samples in [-1, 1] to saturated s16le, with TPDF dither if rng is given."""
+    scaled = samples * 32767
+    if rng is not None:
+        # Triangular noise spanning +/-1 LSB decorrelates the rounding error
+        scaled += rng.triangular(-1.0, 0.0, 1.0, scaled.shape)
+    return np.clip(np.rint(scaled), -32768, 32767).astype("<i2")
+
+
+def resample_chunks(stdout, src_rate: int, src_channels: int, dither: bool = False):
+    """Resample interleaved mono/stereo f32le PCM from stdout with python-soxr.
+
+    Yields s16le mono chunks.
+    """
+    stream = soxr.ResampleStream(src_rate, SAMPLE_RATE, CHANNELS, dtype="float32", quality="VHQ")
+    rng = np.random.default_rng() if dither else None
+
+    # One second of source audio per read keeps memory flat regardless of song length
+    read_size = src_rate * 4 * src_channels
+
+    while True:
+        raw = stdout.read(read_size)
+        last = len(raw) < read_size
+
+        # Average L/R, matching ffmpeg's normalized s16 mono downmix of stereo
+        frames = np.frombuffer(raw, dtype="<f4").reshape(-1, src_channels)
+        samples = stream.resample_chunk(frames.mean(axis=1, dtype=np.float32), last=last)
+        yield quantize_s16(samples, rng)
+
+        if last:
+            return
+
+
+def convert_audio(input_file: str, fd: int, dither: bool = False) -> int:
+    """Convert audio file to raw 16-bit mono PCM, streaming it to fd.
+
+    Returns the number of PCM bytes written, not counting sector padding.
+    """
+    print(f"Loading: {input_file}")
+
+    if soxr is not None:
+        # ffmpeg only decodes at the native rate; downmix and resample happen here.
+        # A plain channel average only matches ffmpeg's mono level for mono/stereo, so
+        # wider layouts (e.g. 5.1 with LFE and surrounds) go through ffmpeg's stereo
+        # downmix first. ffmpeg only normalizes downmix gains for integer output, so
+        # rematrix_maxval asks for the same normalization on the f32le output.
+        src_rate, src_channels = probe_audio(input_file)
+        channels = min(src_channels, 2)
+        cmd = FFMPEG + ["-y", "-i", input_file, "-map", "0:a:0", "-ac", str(channels)]
+        cmd += ["-rematrix_maxval", "1.0", "-f", "f32le", "-"]
+
+        def stream_pcm(stdout):
+            return write_blocks(fd, resample_chunks(stdout, src_rate, channels, dither))
+
+        print(f"Converting with python-soxr ({src_rate}Hz -> {SAMPLE_RATE}Hz)...")
+        returncode, pcm_bytes, stderr = run_ffmpeg(cmd, stream_pcm)
+        if returncode != 0:
+            print(f"ffmpeg error: {stderr.decode(errors='replace')}")
+            sys.exit(1)
+
+    else:
+        if dither:
+            print("Note: --dither needs python-soxr, quantizing without dither")
+
+        # Try ffmpeg's soxr resampler first, fall back to default
+        cmd_base = FFMPEG + [
             "-y",
             "-i",
             input_file,
+            "-map",
+            "0:a:0",
             "-ac",
             str(CHANNELS),
             "-ar",
@@ -42,89 +205,87 @@ def convert_audio(input_file: str) -> bytes:
             "s16",
             "-f",
             "s16le",
-            tmp_path,
+            "-",
         ]
-        cmd_soxr = cmd_base.copy()
-        cmd_soxr.insert(-2, "-af")
-        cmd_soxr.insert(-2, "aresample=resampler=soxr:precision=28")
+        cmd_soxr = cmd_base[:-3] + ["-af", "aresample=resampler=soxr:precision=28"] + cmd_base[-3:]
+
+        def stream_pcm(stdout):
+            return write_blocks(fd, iter(lambda: stdout.read(PIPE_READ_SIZE), b""))
 
         print("Converting with ffmpeg (soxr resampler)...")
-        result = subprocess.run(cmd_soxr, capture_output=True, text=True)
+        returncode, pcm_bytes, stderr = run_ffmpeg(cmd_soxr, stream_pcm)
 
-        if result.returncode != 0:
+        if returncode != 0:
             print("Note: soxr not available, using default resampler")
-            result = subprocess.run(cmd_base, capture_output=True, text=True)
-            if result.returncode != 0:
-                print(f"ffmpeg error: {result.stderr}")
+            os.lseek(fd, 0, os.SEEK_SET)
+            returncode, pcm_bytes, stderr = run_ffmpeg(cmd_base, stream_pcm)
+            if returncode != 0:
+                print(f"ffmpeg error: {stderr.decode(errors='replace')}")
                 sys.exit(1)
 
-        with open(tmp_path, "rb") as f:
-            raw_data = f.read()
-
-        duration_sec = len(raw_data) / (SAMPLE_RATE * 2)
-        print(f"Duration: {duration_sec:.2f} seconds")
-        print(f"Format: {SAMPLE_RATE}Hz, {BITS_PER_SAMPLE}-bit, mono")
-
-        return raw_data
-
-    finally:
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
+    duration_sec = pcm_bytes / (SAMPLE_RATE * 2)
+    print(f"Duration: {duration_sec:.2f} seconds")
+    print(f"Format: {SAMPLE_RATE}Hz, {BITS_PER_SAMPLE}-bit, mono")
 
+    return pcm_bytes
 
-def write_to_device(raw_data: bytes, device_path: str) -> None:
-    """Write raw audio data directly to SD card starting at sector 0."""
-    padding_needed = (SECTOR_SIZE - (len(raw_data) % SECTOR_SIZE)) % SECTOR_SIZE
-    if padding_needed > 0:
-        raw_data = raw_data + (b"\x00" * padding_needed)
 
-    total_sectors = len(raw_data) // SECTOR_SIZE
-    total_bytes = len(raw_data)
-
-    print(f"\nData size: {total_bytes:,} bytes ({total_sectors:,} sectors)")
+def write_to_device(input_file: str, device_path: str, dither: bool = False) -> None:
+    """Convert audio and stream it directly to SD card starting at sector 0."""
     print(f"Device: {device_path}")
-    print(f"\n{'=' * 50}")
-    print(f"MAX_SECTORS = {total_sectors}")
-    print(f"{'=' * 50}")
-    print("\nUpdate audio_controller.sv with this value!")
-
     print(f"\nWARNING: This will DESTROY ALL DATA on {device_path}")
     confirm = input("Type 'YES' to confirm: ")
     if confirm != "YES":
         print("Aborted.")
         sys.exit(1)
 
-    print(f"\nWriting {total_sectors:,} sectors...")
+    print(f"\nWriting to {device_path}...")
 
     try:
-        with open(device_path, "r+b") as f:
-            bytes_written = 0
-            sector = 0
-
-            while bytes_written < total_bytes:
-                chunk = raw_data[bytes_written : bytes_written + SECTOR_SIZE]
-                f.write(chunk)
-                bytes_written += len(chunk)
-                sector += 1
-
-                if sector % 1000 == 0:
-                    pct = (bytes_written / total_bytes) * 100
-                    print(f"  Sector {sector:,} / {total_sectors:,} ({pct:.1f}%)")
-
-            f.flush()
-            os.fsync(f.fileno())
-
-        print(f"\nSuccess! Wrote {total_sectors:,} sectors to {device_path}")
-        print(f"\nRemember to set MAX_SECTORS = {total_sectors} in audio_controller.sv")
+        fd = open_device(device_path)
+        try:
+            convert_audio(input_file, fd, dither)
+            # Output is sector-padded, so the file offset is the sector-aligned size
+            total_bytes = os.lseek(fd, 0, os.SEEK_CUR)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
     except PermissionError:
         print("Error: Permission denied. Try running with sudo:")
-        print(f"  sudo python {sys.argv[0]} {sys.argv[1]} {sys.argv[2]}")
+        print(f"  sudo python {' '.join(sys.argv)}")
         sys.exit(1)
     except Exception as e:
         print(f"Error writing to device: {e}")
         sys.exit(1)
 
+    total_sectors = total_bytes // SECTOR_SIZE
+
+    print(f"\nData size: {total_bytes:,} bytes ({total_sectors:,} sectors)")
+    print(f"\n{'=' * 50}")
+    print(f"MAX_SECTORS = {total_sectors}")
+    print(f"{'=' * 50}")
+
+    print(f"\nSuccess! Wrote {total_sectors:,} sectors to {device_path}")
+    print(f"\nRemember to set MAX_SECTORS = {total_sectors} in audio_controller.sv")
+
+
+def open_device(device_path: str) -> int:
+    """Open device for writing, bypassing the page cache where the OS allows it."""
+    # Linux: O_DIRECT, which needs sector-aligned buffers, offsets and lengths
+    if hasattr(os, "O_DIRECT"):
+        try:
+            return os.open(device_path, os.O_WRONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+
+    fd = os.open(device_path, os.O_WRONLY)
+    # macOS: F_NOCACHE is the O_DIRECT equivalent
+    if hasattr(fcntl, "F_NOCACHE"):
+        fcntl.fcntl(fd, fcntl.F_NOCACHE, 1)
+    return fd
+
 
 def validate_device_path(device_path: str) -> None:
     """Validate device path and warn about system disks."""
@@ -145,21 +306,23 @@ def validate_device_path(device_path: str) -> None:
 
 
 def check_ffmpeg() -> None:
-    """Verify ffmpeg is installed."""
-    try:
-        subprocess.run(["ffmpeg", "-version"], capture_output=True, check=True)
-    except FileNotFoundError:
-        print("Error: ffmpeg not found. Install with: brew install ffmpeg")
-        sys.exit(1)
+    """Verify ffmpeg (and ffprobe, which ships with it) is installed."""
+    for tool in ("ffmpeg", "ffprobe"):
+        if shutil.which(tool) is None:
+            print(f"Error: {tool} not found. Install with: brew install ffmpeg")
+            sys.exit(1)
 
 
 def main():
-    if len(sys.argv) != 3:
+    args = [arg for arg in sys.argv[1:] if arg != "--dither"]
+    dither = len(args) != len(sys.argv) - 1
+
+    if len(args) != 2:
         print(__doc__)
         sys.exit(1)
 
-    input_file = sys.argv[1]
-    device_path = sys.argv[2]
+    input_file = args[0]
+    device_path = args[1]
 
     if not os.path.exists(input_file):
         print(f"Error: Input file not found: {input_file}")
@@ -168,8 +331,7 @@ def main():
     validate_device_path(device_path)
     check_ffmpeg()
 
-    raw_data = convert_audio(input_file)
-    write_to_device(raw_data, device_path)
+    write_to_device(input_file, device_path, dither)
 
 
 if __name__ == "__main__":